@@ -0,0 +1,81 @@
+"""
+Tail-latency benchmark for hedged upstream requests. Runs the same King
+workload twice against a fake upstream with injected stragglers, once with
+HEDGE_ENABLED=false and once with it on, and reports end-to-end latency
+percentiles plus how many hedges were sent and won.
+
+    cd backend && python benchmarks/bench_hedging.py --tail-rate 0.05 --tail-latency 5
+"""
+import argparse
+import asyncio
+import os
+import re
+import subprocess
+import sys
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import BACKEND_DIR, run_scenario, wait_ready  # noqa: E402
+
+def hedge_counts(metrics: str) -> dict:
+    counts = {"won": 0.0, "lost": 0.0}
+    for outcome, value in re.findall(r'polter_upstream_hedges_total\{[^}]*outcome="(\w+)"\} ([\d.]+)', metrics):
+        counts[outcome] += float(value)
+    return counts
+
+async def run(args, hedge: bool) -> dict:
+    fake_port, api_port = args.port + 1, args.port
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(BACKEND_DIR, "benchmarks", "fake_upstream.py"), "--port", str(fake_port),
+        "--latency", str(args.latency), "--tail-rate", str(args.tail_rate), "--tail-latency", str(args.tail_latency),
+    ])
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+        "RESULT_CACHE_BACKEND": "off",
+        "HEDGE_ENABLED": "true" if hedge else "false",
+        "HEDGE_PERCENTILE": str(args.percentile),
+        "HEDGE_MAX_RATE": str(args.max_rate),
+    }
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(api_port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+    try:
+        await wait_ready(f"http://127.0.0.1:{fake_port}/stats")
+        await wait_ready(f"http://127.0.0.1:{api_port}/health")
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{api_port}", timeout=300) as client:
+            # Warm the latency tracker so hedging has a percentile to work from
+            await run_scenario(client, "/humanize", args.tier, 100, args.warmup, args.concurrency, 0)
+            result = await run_scenario(client, "/humanize", args.tier, args.words, args.requests, args.concurrency, api.pid)
+            result["hedges"] = hedge_counts((await client.get("/metrics")).text)
+        return result
+    finally:
+        for process in (api, fake):
+            process.terminate()
+            process.wait()
+
+async def main(args) -> None:
+    for hedge in (False, True):
+        result = await run(args, hedge)
+        hedges = result["hedges"]
+        print(f"hedging {'on ' if hedge else 'off'}  p50 {result['p50']:.3f}s  p95 {result['p95']:.3f}s  p99 {result['p99']:.3f}s  "
+              f"{result['rps']:5.1f} rps  errors {result['errors']}  hedges sent {hedges['won'] + hedges['lost']:.0f} won {hedges['won']:.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare tail latency with and without hedged upstream requests.")
+    parser.add_argument("--port", type=int, default=8300, help="API port; the fake upstream uses port + 1")
+    parser.add_argument("--tier", default="king")
+    parser.add_argument("--words", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--tail-rate", type=float, default=0.05)
+    parser.add_argument("--tail-latency", type=float, default=3.0)
+    parser.add_argument("--percentile", type=float, default=95)
+    parser.add_argument("--max-rate", type=float, default=0.1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,92 @@
+"""
+Micro-benchmark: compiled single-pass rule engine vs the original
+one-re.sub-per-rule loops, on generated 10k-word inputs.
+
+    cd backend && python benchmarks/bench_rules.py
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+WORDS = 10000
+REPEAT = 5
+
+FILLER = (
+    "the system was built to process information quickly and it is clear that "
+    "we are not done yet because they are still testing what does not work"
+).split()
+PHRASES = [
+    "Furthermore,", "Moreover,", "In conclusion,", "It is important to note that",
+    "Additionally,", "Therefore", "In summary,", "It goes without saying",
+    "do not", "cannot", "will not", "I am", "you are", "there is", "it is not",
+]
+
+def make_document(words: int, seed: int = 42) -> str:
+    rng = random.Random(seed)
+    sentences = []
+    count = 0
+    while count < words:
+        length = rng.randint(6, 40)
+        parts = [rng.choice(PHRASES)] if rng.random() < 0.4 else []
+        parts += [rng.choice(FILLER) for _ in range(length)]
+        sentences.append(" ".join(parts).capitalize() + ".")
+        count += length
+    return " ".join(sentences)
+
+# --- Original implementations (baseline) ---
+
+def legacy_preprocess(text: str) -> str:
+    for pattern in main.AI_PATTERNS:
+        text = re.sub(pattern, "", text, flags=re.IGNORECASE)
+    sentences = re.split(r'(?<=[.!?]) +', text)
+    processed = []
+    for s in sentences:
+        words = s.split()
+        if len(words) > 25:
+            mid = len(words) // 2
+            processed.append(" ".join(words[:mid]) + ",")
+            processed.append(" ".join(words[mid:]))
+        else:
+            processed.append(s)
+    return " ".join(processed)
+
+def legacy_postprocess(text: str) -> str:
+    for full, short in main.CONTRACTIONS.items():
+        if random.random() > 0.2:
+            text = re.sub(rf"\b{full}\b", short, text, flags=re.IGNORECASE)
+    return re.sub(r'\s+', ' ', text).strip()
+
+def legacy_enhanced_postprocess(text: str) -> str:
+    text = legacy_postprocess(text)
+    for pattern in main.KING_AI_PHRASE_PATTERNS:
+        text = re.sub(pattern, "", text, flags=re.IGNORECASE)
+    text = re.sub(r'\s+', ' ', text).strip()
+    text = re.sub(r'\s+([.,!?;:])', r'\1', text)
+    text = re.sub(r'([.,!?;:])\s*([A-Z])', r'\1 \2', text)
+    return text
+
+STAGES = [
+    ("rule_based_preprocess", legacy_preprocess, main.rule_based_preprocess),
+    ("rule_based_postprocess", legacy_postprocess, main.rule_based_postprocess),
+    ("enhanced_postprocess_king", legacy_enhanced_postprocess, main.enhanced_postprocess_king),
+]
+
+def seeded(fn, text):
+    random.seed(7)
+    return fn(text)
+
+if __name__ == "__main__":
+    document = make_document(WORDS)
+    print(f"{WORDS}-word document, best of {REPEAT}")
+    for name, legacy, current in STAGES:
+        same = seeded(legacy, document) == seeded(current, document)
+        before = min(timeit.repeat(lambda: seeded(legacy, document), number=1, repeat=REPEAT))
+        after = min(timeit.repeat(lambda: seeded(current, document), number=1, repeat=REPEAT))
+        print(f"{name:28} {before * 1000:8.2f} ms -> {after * 1000:8.2f} ms  "
+              f"x{before / after:5.2f}  identical output: {same}")
@@ -0,0 +1,159 @@
+"""
+Micro-benchmarks for the pure-Python text stages on a generated corpus
+(100 to 10,000 words, fixed seeds). Every stage runs under the same
+random.seed before each call, so timings are comparable between runs and
+between commits.
+
+    cd backend && python benchmarks/bench_stages.py --out benchmarks/results/stages.json
+    cd backend && python benchmarks/bench_stages.py --compare benchmarks/results/stages.json
+    cd backend && python benchmarks/bench_stages.py --rev HEAD~1 --rev WORKTREE
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_rules import make_document  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = [100, 1000, 5000, 10000]
+SEED = 7
+SENTENCE_RE = re.compile(r'(?<=[.!?]) +')
+
+def make_corpus(words: int) -> str:
+    """A document of about `words` words in paragraphs of ~120 words."""
+    paragraphs = [make_document(120, seed=i) for i in range(max(1, words // 120))]
+    return "\n\n".join(paragraphs)
+
+def split_sentences(text: str) -> list:
+    return SENTENCE_RE.split(" ".join(text.split()))
+
+def stage_calls(module) -> dict:
+    """Stage name -> (function, argument factory); stages missing from module are skipped."""
+    stages = {
+        "chunk_text_king": ("chunk_text_king", lambda doc: doc),
+        "rule_based_preprocess": ("rule_based_preprocess", lambda doc: doc),
+        "rule_based_postprocess": ("rule_based_postprocess", lambda doc: doc),
+        "enhanced_postprocess_king": ("enhanced_postprocess_king", lambda doc: doc),
+        "vary_sentence_rhythm_king": ("vary_sentence_rhythm_king", split_sentences),
+        "inject_transitions_king": ("inject_transitions_king", split_sentences),
+        "inject_emphasis_king": ("inject_emphasis_king", split_sentences),
+        "inject_hedging_king": ("inject_hedging_king", split_sentences),
+    }
+    calls = {}
+    for name, (attr, prepare) in stages.items():
+        fn = getattr(module, attr, None)
+        if fn is None:
+            continue
+        if name == "inject_hedging_king":
+            # Applied per sentence by the pipeline
+            calls[name] = (lambda sentences, fn=fn: [fn(s) for s in sentences], prepare)
+        else:
+            calls[name] = (fn, prepare)
+    return calls
+
+def load_main(rev: str, workdir: str):
+    """Import backend/main.py as of a git revision ("WORKTREE" for the files on disk)."""
+    if rev == "WORKTREE":
+        path = os.path.join(BACKEND_DIR, "main.py")
+    else:
+        source = subprocess.run(
+            ["git", "show", f"{rev}:backend/main.py"], cwd=BACKEND_DIR,
+            check=True, capture_output=True, text=True,
+        ).stdout
+        path = os.path.join(workdir, f"main_{re.sub(r'[^A-Za-z0-9]', '_', rev)}.py")
+        with open(path, "w") as f:
+            f.write(source)
+    name = "bench_main_" + re.sub(r'[^A-Za-z0-9]', '_', rev)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def time_stage(fn, arg, repeat: int, number: int) -> dict:
+    def run():
+        random.seed(SEED)
+        fn(arg if isinstance(arg, str) else list(arg))
+    times = [t / number for t in timeit.repeat(run, number=number, repeat=repeat)]
+    return {"min_ms": min(times) * 1000, "median_ms": statistics.median(times) * 1000}
+
+def run_benchmarks(modules: dict, sizes: list, repeat: int) -> dict:
+    """{label: {stage: {words: timing}}}; revisions are interleaved per stage and size."""
+    corpus = {words: make_corpus(words) for words in sizes}
+    results = {label: {} for label in modules}
+    calls = {label: stage_calls(module) for label, module in modules.items()}
+    stages = [name for name in calls[next(iter(calls))]]
+    for stage in stages:
+        for words in sizes:
+            number = max(1, 2000 // words)  # Keep small inputs above timer resolution
+            for label in modules:
+                if stage not in calls[label]:
+                    continue
+                fn, prepare = calls[label][stage]
+                timing = time_stage(fn, prepare(corpus[words]), repeat, number)
+                results[label].setdefault(stage, {})[str(words)] = timing
+                print(f"{label:12} {stage:28} {words:6}w  min {timing['min_ms']:9.3f} ms  median {timing['median_ms']:9.3f} ms")
+    return results
+
+def find_regressions(before: dict, after: dict, threshold: float) -> list:
+    """Stage/size pairs whose min time grew by more than threshold (a fraction)."""
+    regressions = []
+    for stage, by_size in after.items():
+        for words, timing in by_size.items():
+            old = before.get(stage, {}).get(words)
+            if not old or not old["min_ms"]:
+                continue
+            change = timing["min_ms"] / old["min_ms"] - 1
+            if change > threshold:
+                regressions.append(f"{stage} {words}w: {old['min_ms']:.3f} -> {timing['min_ms']:.3f} ms ({change:+.0%})")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pure-Python text stages.")
+    parser.add_argument("--rev", action="append", help="Git revision to benchmark, or WORKTREE (repeatable; default WORKTREE)")
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--out", help="Write results of the last revision as JSON")
+    parser.add_argument("--compare", help="Baseline JSON to check the last revision against")
+    parser.add_argument("--threshold", type=float, default=0.20, help="Allowed slowdown as a fraction")
+    args = parser.parse_args()
+    revs = args.rev or ["WORKTREE"]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        modules = {rev: load_main(rev, workdir) for rev in revs}
+        results = run_benchmarks(modules, args.sizes, args.repeat)
+
+    latest = results[revs[-1]]
+    regressions = []
+    if len(revs) > 1:
+        regressions += [f"{revs[0]} -> {revs[-1]} {line}" for line in find_regressions(results[revs[0]], latest, args.threshold)]
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["stages"]
+        regressions += [f"baseline -> {revs[-1]} {line}" for line in find_regressions(baseline, latest, args.threshold)]
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "rev": revs[-1],
+                "seed": SEED,
+                "stages": latest,
+            }, f, indent=2)
+        print(f"Saved {args.out}")
+
+    for line in regressions:
+        print("REGRESSION", line)
+    if args.compare or len(revs) > 1:
+        print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
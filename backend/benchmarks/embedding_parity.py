@@ -0,0 +1,85 @@
+"""
+Parity and speed check for the embedding backends behind
+semantic_similarity_king. Scores (original, rewritten) pairs from the
+generated corpus with the torch baseline and each candidate backend and
+fails if any similarity drifts more than --tolerance from the baseline.
+
+    cd backend && SEMANTIC_MODEL_PATH=/models/all-MiniLM-L6-v2 python benchmarks/embedding_parity.py --backends int8 onnx
+    cd backend && python benchmarks/embedding_parity.py --export-onnx /models/all-MiniLM-L6-v2-onnx
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import embeddings  # noqa: E402
+import main  # noqa: E402
+from bench_rules import make_document  # noqa: E402
+
+def make_pairs(count: int, seed: int = 7) -> list:
+    """Chunk-sized originals paired with lightly and heavily edited rewrites."""
+    rng = random.Random(seed)
+    pairs = []
+    for i in range(count):
+        original = make_document(rng.choice([50, 200, 400]), seed=i)
+        words = original.split()
+        edits = int(len(words) * rng.choice([0.05, 0.3, 0.8]))
+        for _ in range(edits):
+            words[rng.randrange(len(words))] = rng.choice(words)
+        pairs.append((original, " ".join(words)))
+    return pairs
+
+def score(model, pairs: list) -> tuple:
+    """(similarities, seconds) for the pairs, encoded like EmbeddingService does."""
+    texts = [text for pair in pairs for text in pair]
+    started = time.perf_counter()
+    vectors = model.encode(texts, batch_size=embeddings.EMBEDDING_MAX_BATCH, convert_to_numpy=True, normalize_embeddings=True)
+    elapsed = time.perf_counter() - started
+    return np.einsum("ij,ij->i", vectors[0::2], vectors[1::2]), elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check embedding backends against the torch baseline.")
+    parser.add_argument("--backends", nargs="+", default=["int8", "onnx"])
+    parser.add_argument("--pairs", type=int, default=200)
+    parser.add_argument("--tolerance", type=float, default=0.02, help="Max absolute similarity difference")
+    parser.add_argument("--export-onnx", metavar="DIR", help="Export the model as ONNX to DIR and exit")
+    args = parser.parse_args()
+
+    if args.export_onnx:
+        model = embeddings.build_semantic_model("onnx")
+        model.save_pretrained(args.export_onnx)
+        print(f"Exported ONNX model to {args.export_onnx}")
+        sys.exit(0)
+
+    pairs = make_pairs(args.pairs)
+    baseline, baseline_seconds = score(embeddings.build_semantic_model("torch"), pairs)
+    print(f"torch      {baseline_seconds * 1000:8.1f} ms for {len(pairs)} pairs")
+
+    failed = False
+    for backend in args.backends:
+        try:
+            model = embeddings.build_semantic_model(backend)
+        except Exception as e:
+            print(f"{backend:10} unavailable: {e}")
+            failed = True
+            continue
+        scores, seconds = score(model, pairs)
+        drift = np.abs(scores - baseline)
+        # A score moving across the King thresholds changes which chunks fall back
+        flips = sum(
+            int((a >= t) != (b >= t))
+            for a, b in zip(baseline, scores)
+            for t in {p.similarity_threshold for p in main.PIPELINES.values() if p.similarity_threshold}
+        )
+        ok = drift.max() <= args.tolerance
+        failed |= not ok
+        print(f"{backend:10} {seconds * 1000:8.1f} ms  x{baseline_seconds / seconds:5.2f}  "
+              f"max drift {drift.max():.4f}  mean drift {drift.mean():.4f}  threshold flips {flips}  "
+              f"{'OK' if ok else 'FAIL'}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,159 @@
+"""
+Fake OpenAI-compatible upstream for load tests. Serves /v1/chat/completions
+(plain and streamed) without calling OpenAI: the reply is the prompt's text
+reworded and resized, after a configurable delay, with a configurable share
+of failures. Responses carry x-ratelimit-* headers so the API's limiter can
+tune itself.
+
+    cd backend && python benchmarks/fake_upstream.py --port 9100 --latency 0.5 --error-rate 0.02
+    cd backend && python benchmarks/fake_upstream.py --port 9100 --tail-rate 0.05 --tail-latency 5
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=fake python -m uvicorn main:app
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Each setting can also be given as an environment variable
+LATENCY = float(os.getenv("FAKE_LATENCY", "0.5"))  # Seconds before the first token
+LATENCY_JITTER = float(os.getenv("FAKE_LATENCY_JITTER", "0.2"))  # +/- fraction of LATENCY
+TAIL_RATE = float(os.getenv("FAKE_TAIL_RATE", "0"))  # Share of calls that are slow stragglers
+TAIL_LATENCY = float(os.getenv("FAKE_TAIL_LATENCY", "5"))  # Extra seconds for a straggler
+TOKENS_PER_SECOND = float(os.getenv("FAKE_TOKENS_PER_SECOND", "0"))  # 0 = no generation delay
+ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", "0"))
+ERROR_STATUS = int(os.getenv("FAKE_ERROR_STATUS", "503"))
+OUTPUT_RATIO = float(os.getenv("FAKE_OUTPUT_RATIO", "1.08"))  # Output words per input word
+REQUESTS_PER_MINUTE = int(os.getenv("FAKE_REQUESTS_PER_MINUTE", "10000"))
+TOKENS_PER_MINUTE = int(os.getenv("FAKE_TOKENS_PER_MINUTE", "30000000"))
+
+app = FastAPI(title="Fake OpenAI upstream")
+stats = {"requests": 0, "errors": 0, "started": time.time()}
+seen_prefixes = set()
+
+def cached_tokens(messages: list) -> int:
+    """Emulates OpenAI prefix caching: a repeated system message of 1024+ tokens is cached in 128-token steps."""
+    prefix = messages[0]["content"] if len(messages) > 1 else ""
+    tokens = len(prefix) // 4
+    if tokens < 1024:
+        return 0
+    if prefix not in seen_prefixes:
+        seen_prefixes.add(prefix)
+        return 0
+    return tokens - tokens % 128
+
+def source_text(prompt: str) -> str:
+    """The text being rewritten: after the last "Text:" label, before any trailing notes."""
+    text = prompt.rsplit("Text:", 1)[-1]
+    for note in ("\nPreceding context (", "\nThe text contains "):
+        text = text.split(note, 1)[0]
+    return text.strip()
+
+def fake_rewrite(text: str, ratio: float, max_tokens: int) -> str:
+    """Resizes text to about ratio times its words, keeping paragraphs and section markers."""
+    paragraphs = []
+    budget = max(1, int(max_tokens * 0.75))  # ~0.75 words per token
+    for paragraph in text.split("\n\n"):
+        words = paragraph.split()
+        if not words:
+            continue
+        if words[0].startswith("<<<"):
+            paragraphs.append(paragraph)
+            continue
+        target = max(1, int(len(words) * ratio))
+        resized = (words * (target // len(words) + 1))[:target]
+        paragraphs.append(" ".join(resized[:budget]))
+        budget -= len(resized)
+        if budget <= 0:
+            break
+    return "\n\n".join(paragraphs)
+
+def rate_limit_headers() -> dict:
+    return {
+        "x-ratelimit-limit-requests": str(REQUESTS_PER_MINUTE),
+        "x-ratelimit-remaining-requests": str(REQUESTS_PER_MINUTE - 1),
+        "x-ratelimit-limit-tokens": str(TOKENS_PER_MINUTE),
+        "x-ratelimit-remaining-tokens": str(TOKENS_PER_MINUTE - 1000),
+    }
+
+def chunk_event(model: str, content: str = None, usage: dict = None) -> str:
+    event = {
+        "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+        "choices": [] if usage else [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+    }
+    if usage:
+        event["usage"] = usage
+    return "data: " + json.dumps(event) + "\n\n"
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    prompt = body["messages"][-1]["content"]
+    delay = LATENCY * (1 + random.uniform(-LATENCY_JITTER, LATENCY_JITTER))
+    if random.random() < TAIL_RATE:
+        delay += TAIL_LATENCY
+    await asyncio.sleep(max(0.0, delay))
+
+    if random.random() < ERROR_RATE:
+        stats["errors"] += 1
+        return JSONResponse(
+            {"error": {"message": "Fake upstream error", "type": "server_error"}},
+            status_code=ERROR_STATUS,
+            headers={**rate_limit_headers(), "retry-after": "1"},
+        )
+
+    output = fake_rewrite(source_text(prompt), OUTPUT_RATIO, body.get("max_tokens") or 16384)
+    usage = {
+        "prompt_tokens": sum(len(message["content"]) for message in body["messages"]) // 4,
+        "completion_tokens": len(output) // 4,
+        "total_tokens": (len(prompt) + len(output)) // 4,
+        "prompt_tokens_details": {"cached_tokens": cached_tokens(body["messages"])},
+    }
+
+    if body.get("stream"):
+        async def events():
+            for word in output.split(" "):
+                if TOKENS_PER_SECOND:
+                    await asyncio.sleep(1 / TOKENS_PER_SECOND)
+                yield chunk_event(body["model"], word + " ")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield chunk_event(body["model"], usage=usage)
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream", headers=rate_limit_headers())
+
+    if TOKENS_PER_SECOND:
+        await asyncio.sleep(usage["completion_tokens"] / TOKENS_PER_SECOND)
+    return JSONResponse({
+        "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": output}, "finish_reason": "stop"}],
+        "usage": usage,
+    }, headers=rate_limit_headers())
+
+@app.get("/stats")
+async def get_stats():
+    return {**stats, "uptime": time.time() - stats["started"]}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=LATENCY)
+    parser.add_argument("--latency-jitter", type=float, default=LATENCY_JITTER)
+    parser.add_argument("--tail-rate", type=float, default=TAIL_RATE)
+    parser.add_argument("--tail-latency", type=float, default=TAIL_LATENCY)
+    parser.add_argument("--tokens-per-second", type=float, default=TOKENS_PER_SECOND)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE)
+    parser.add_argument("--error-status", type=int, default=ERROR_STATUS)
+    parser.add_argument("--output-ratio", type=float, default=OUTPUT_RATIO)
+    args = parser.parse_args()
+    LATENCY, LATENCY_JITTER, TOKENS_PER_SECOND = args.latency, args.latency_jitter, args.tokens_per_second
+    TAIL_RATE, TAIL_LATENCY = args.tail_rate, args.tail_latency
+    ERROR_RATE, ERROR_STATUS, OUTPUT_RATIO = args.error_rate, args.error_status, args.output_ratio
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
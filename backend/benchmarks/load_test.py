@@ -0,0 +1,213 @@
+"""
+Load test for /humanize and /paraphrase against the fake upstream. Starts
+fake_upstream.py and the API (unless --url is given), then drives every
+endpoint x tier x document size at a fixed concurrency and reports latency
+percentiles, throughput and the API's resident memory. Results are written
+as JSON; --compare flags regressions against an earlier baseline.
+
+    cd backend && python benchmarks/load_test.py --out benchmarks/results/baseline.json
+    cd backend && python benchmarks/load_test.py --compare benchmarks/results/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_rules import make_document  # noqa: E402
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ["/humanize", "/paraphrase"]
+TIERS = ["ghost-mini", "ghost-pro", "king"]
+SIZES = [100, 1000, 5000, 10000]
+WORD_LIMITS = {"king": 10000}  # Others allow 5,000 words
+DEFAULT_WORD_LIMIT = 5000
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def rss_mb(pid: int) -> float:
+    """Resident set size of pid and its children from /proc (Linux only), in MB."""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+async def wait_ready(url: str, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+async def run_scenario(client: httpx.AsyncClient, endpoint: str, tier: str, words: int, requests: int, concurrency: int, pid: int) -> dict:
+    # Distinct documents per request so the result cache and single-flight don't short-circuit
+    documents = [make_document(words, seed=i) for i in range(requests)]
+    latencies, errors, peak_rss = [], 0, 0.0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(text: str) -> None:
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post(endpoint, json={"text": text, "model": tier})
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    async def sample_rss() -> None:
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, rss_mb(pid))
+            await asyncio.sleep(0.1)
+
+    sampler = asyncio.create_task(sample_rss()) if pid else None
+    started = time.perf_counter()
+    await asyncio.gather(*(one(text) for text in documents))
+    elapsed = time.perf_counter() - started
+    if sampler:
+        sampler.cancel()
+
+    return {
+        "endpoint": endpoint,
+        "tier": tier,
+        "words": words,
+        "requests": requests,
+        "errors": errors,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "rss_mb": peak_rss,
+    }
+
+def compare(results: list, baseline_path: str, threshold: float) -> list:
+    """Scenario metrics worse than the baseline by more than threshold (a fraction)."""
+    with open(baseline_path) as f:
+        baseline = {(r["endpoint"], r["tier"], r["words"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get((result["endpoint"], result["tier"], result["words"]))
+        if not before:
+            continue
+        for metric, higher_is_worse in (("p50", True), ("p95", True), ("p99", True), ("rps", False), ("rss_mb", True)):
+            old, new = before[metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) / old if higher_is_worse else (old - new) / old
+            if change > threshold:
+                regressions.append(f"{result['endpoint']} {result['tier']} {result['words']}w {metric}: {old:.3f} -> {new:.3f} ({change:+.0%})")
+    return regressions
+
+async def main(args) -> int:
+    processes = []
+    pid = 0
+    url = args.url
+    try:
+        if not url:
+            fake_port, api_port = args.port + 1, args.port
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(BACKEND_DIR, "benchmarks", "fake_upstream.py"), "--port", str(fake_port),
+                 "--latency", str(args.latency), "--error-rate", str(args.error_rate)],
+            ))
+            env = {
+                **os.environ,
+                "OPENAI_API_KEY": "fake",
+                "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+                "RESULT_CACHE_BACKEND": "off",
+            }
+            api = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "main:app", "--port", str(api_port), "--log-level", "warning"],
+                cwd=BACKEND_DIR, env=env,
+            )
+            processes.append(api)
+            pid = api.pid
+            url = f"http://127.0.0.1:{api_port}"
+            await wait_ready(f"http://127.0.0.1:{fake_port}/stats")
+        await wait_ready(f"{url}/health")
+
+        results = []
+        async with httpx.AsyncClient(base_url=url, timeout=args.timeout) as client:
+            for endpoint in args.endpoints:
+                for tier in args.tiers:
+                    for words in args.sizes:
+                        if words > WORD_LIMITS.get(tier, DEFAULT_WORD_LIMIT):
+                            continue
+                        result = await run_scenario(client, endpoint, tier, words, args.requests, args.concurrency, pid)
+                        results.append(result)
+                        print(f"{endpoint:12} {tier:10} {words:6}w  p50 {result['p50']:.3f}s  p95 {result['p95']:.3f}s  "
+                              f"p99 {result['p99']:.3f}s  {result['rps']:6.1f} rps  {result['rss_mb']:7.1f} MB  errors {result['errors']}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "results": results,
+    }
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {len(results)} scenarios to {args.out}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            return 1
+        print(f"No regressions over {args.threshold:.0%} against {args.compare}")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the humanizer API against a fake upstream.")
+    parser.add_argument("--url", help="Test a running API instead of starting one (RSS is not sampled)")
+    parser.add_argument("--port", type=int, default=8100, help="API port; the fake upstream uses port + 1")
+    parser.add_argument("--endpoints", nargs="+", default=ENDPOINTS)
+    parser.add_argument("--tiers", nargs="+", default=TIERS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--requests", type=int, default=20, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake upstream latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--out", default=os.path.join(BACKEND_DIR, "benchmarks", "results", "latest.json"))
+    parser.add_argument("--compare", help="Baseline JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Allowed slowdown as a fraction")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,63 @@
+"""
+Embedding sidecar: owns the one copy of the semantic model on a node and
+serves batched encode requests to the API workers over a Unix socket.
+Requests from all workers share the EmbeddingService micro-batcher and
+memo, so concurrent King chunks still become single forward passes.
+
+    uvicorn embedding_sidecar:app --uds /tmp/polter-embeddings.sock
+    EMBEDDING_SOCKET=/tmp/polter-embeddings.sock uvicorn main:app --workers 8
+
+The sidecar reads the same EMBEDDING_BACKEND / SEMANTIC_MODEL_* settings as main.py,
+from embeddings.py, without importing the API itself.
+"""
+import asyncio
+import os
+from typing import List
+
+import numpy as np
+from fastapi import FastAPI, HTTPException, Response
+from pydantic import BaseModel
+
+from embeddings import EmbeddingService, EMBEDDING_BACKEND, load_semantic_model
+
+app = FastAPI(title="PolterText Embedding Sidecar")
+service = None
+
+class EncodeRequest(BaseModel):
+    texts: List[str]
+
+@app.on_event("startup")
+async def load_model():
+    async def load():
+        global service
+        try:
+            model = await asyncio.get_running_loop().run_in_executor(None, load_semantic_model)
+            service = EmbeddingService(model)
+            print(f"✓ Embedding sidecar ready ({EMBEDDING_BACKEND})")
+        except Exception as e:
+            print(f"Warning: Embedding sidecar could not load model: {e}")
+    app.state.model_load = asyncio.create_task(load())
+
+@app.post("/encode")
+async def encode(request: EncodeRequest):
+    """Normalized float32 embeddings, row-major, with the dimension in X-Embedding-Dim."""
+    if service is None:
+        raise HTTPException(status_code=503, detail="Model is loading")
+    if not request.texts:
+        return Response(content=b"", media_type="application/octet-stream", headers={"X-Embedding-Dim": "0"})
+    vectors = np.asarray(await service.encode(request.texts), dtype=np.float32)
+    return Response(
+        content=vectors.tobytes(),
+        media_type="application/octet-stream",
+        headers={"X-Embedding-Dim": str(vectors.shape[1])}
+    )
+
+@app.get("/health")
+async def health():
+    if service is None:
+        raise HTTPException(status_code=503, detail="Model is loading")
+    return {"status": "ok", "backend": EMBEDDING_BACKEND, **service.stats()}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, uds=os.getenv("EMBEDDING_SOCKET", "/tmp/polter-embeddings.sock"))
@@ -0,0 +1,144 @@
+"""
+Semantic embedding model and the micro-batching EmbeddingService, shared by
+the API (main.py) and the embedding sidecar (embedding_sidecar.py) so the
+sidecar can serve encode calls without importing the rest of the API.
+"""
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Semantic Model ---
+SEMANTIC_MODEL_NAME = os.getenv("SEMANTIC_MODEL_NAME", "all-MiniLM-L6-v2")
+# Embedding backend: "torch" (full precision), "int8" (torch dynamic
+# quantization of the Linear layers) or "onnx" (ONNX Runtime, needs
+# optimum[onnxruntime]). SEMANTIC_MODEL_PATH loads a local copy without
+# touching the network; SEMANTIC_ONNX_FILE picks a file inside it, e.g. a
+# pre-quantized "onnx/model_qint8_avx512.onnx".
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")  # torch, int8, onnx
+SEMANTIC_MODEL_PATH = os.getenv("SEMANTIC_MODEL_PATH", "")
+SEMANTIC_ONNX_FILE = os.getenv("SEMANTIC_ONNX_FILE", "")
+
+def build_semantic_model(backend: str = EMBEDDING_BACKEND, path: str = SEMANTIC_MODEL_PATH):
+    """A SentenceTransformer for the given backend; all expose the same encode() (blocking)."""
+    from sentence_transformers import SentenceTransformer
+    kwargs = {"device": "cpu"}
+    if path:
+        kwargs["local_files_only"] = True
+    if backend == "onnx":
+        kwargs["backend"] = "onnx"
+        if SEMANTIC_ONNX_FILE:
+            kwargs["model_kwargs"] = {"file_name": SEMANTIC_ONNX_FILE}
+    elif backend not in ("torch", "int8"):
+        raise ValueError(f"Unknown EMBEDDING_BACKEND {backend!r}")
+    model = SentenceTransformer(path or SEMANTIC_MODEL_NAME, **kwargs)
+    if backend == "int8":
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+def load_semantic_model():
+    """Import sentence_transformers and build the configured model (blocking)."""
+    model = build_semantic_model()
+    # Warm-up pass so the first King request doesn't pay for lazy init
+    model.encode(["warm up"], convert_to_numpy=True)
+    return model
+
+# --- Embedding Service ---
+# Micro-batches encode calls from concurrent requests into one forward pass,
+# runs inference off the event loop and memoizes embeddings by text hash.
+EMBEDDING_MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", "64"))
+EMBEDDING_BATCH_WINDOW = float(os.getenv("EMBEDDING_BATCH_WINDOW", "0.005"))  # seconds
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+
+class EmbeddingService:
+    def __init__(self, model, max_batch: int = EMBEDDING_MAX_BATCH, batch_window: float = EMBEDDING_BATCH_WINDOW, cache_size: int = EMBEDDING_CACHE_SIZE, on_batch: Optional[Callable[[float, int], None]] = None):
+        self.model = model
+        self.on_batch = on_batch  # Called with (seconds, texts) after each encoded micro-batch
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._pending: "OrderedDict[str, Tuple[str, asyncio.Future]]" = OrderedDict()
+        self._flusher: Optional[asyncio.Task] = None
+        # Single inference thread: torch already parallelizes within a batch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray) -> None:
+        self._cache[key] = vector
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def encode(self, texts: List[str]) -> List[np.ndarray]:
+        """Returns L2-normalized embeddings for texts, in order."""
+        loop = asyncio.get_running_loop()
+        vectors = {}
+        waiting = []
+        for text in dict.fromkeys(texts):
+            key = self._key(text)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                vectors[text] = self._cache[key]
+            elif key in self._pending:
+                waiting.append((text, self._pending[key][1]))
+            else:
+                future = loop.create_future()
+                self._pending[key] = (text, future)
+                waiting.append((text, future))
+
+        if self._pending and (self._flusher is None or self._flusher.done()):
+            self._flusher = asyncio.create_task(self._flush())
+
+        for text, future in waiting:
+            vectors[text] = await asyncio.shield(future)
+        return [vectors[text] for text in texts]
+
+    async def _flush(self) -> None:
+        # Give concurrent callers a moment to join the batch
+        await asyncio.sleep(self.batch_window)
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch = []
+            while self._pending and len(batch) < self.max_batch:
+                key, (text, future) = self._pending.popitem(last=False)
+                batch.append((key, text, future))
+            texts = [text for _, text, _ in batch]
+            started = time.perf_counter()
+            try:
+                encoded = await loop.run_in_executor(
+                    self._executor,
+                    lambda: self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True)
+                )
+                if self.on_batch:
+                    self.on_batch(time.perf_counter() - started, len(texts))
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (key, _, future), vector in zip(batch, encoded):
+                self._remember(key, vector)
+                if not future.done():
+                    future.set_result(vector)
+
+    async def similarities(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """Cosine similarity for each (original, rewritten) pair, encoded in one batch."""
+        texts = [text for pair in pairs for text in pair]
+        vectors = await self.encode(texts)
+        return [float(np.dot(vectors[i], vectors[i + 1])) for i in range(0, len(vectors), 2)]
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "pending": len(self._pending)}